@@ -133,20 +133,36 @@
 # % answer: 2019
 # %end
 
+# %flag
+# % key: l
+# % label: Link the downloaded data with r.external instead of importing it
+# % description: Only used in EPSG:4326 locations for files on the grid of the region; linked maps cover the whole file. Requires the directory option
+# %end
+
 # %rules
+# % requires: -l,directory
 # % requires:discrete_classification_output,bare_coverfraction_output,builtup_coverfraction_output,crops_coverfraction_output,change_confidence_output,data_density_indicator_output,discrete_classification_output,discrete_classification_proba_output,forest_type_output,grass_coverfraction_output,moss_lichen_coverfraction_output,permanent_water_coverfraction_output,seasonal_water_coverfraction_output,shrub_coverfraction_output,snow_coverfraction_output,tree_coverfraction_output
 # %end
 
 import atexit
+import hashlib
+import http.client
+import json
+import math
+import mmap
 import os
-import pickle
-import psutil
 import shutil
+import subprocess
 import sys
-import wget
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from itertools import repeat
 
 import grass.script as grass
-from osgeo.gdal import Warp
+from osgeo import osr
+from osgeo.gdal import BuildVRT, Open, Translate, Warp
 from zenodo_get.zget import zenodo_get
 
 rm_folders = []
@@ -155,10 +171,18 @@ if "GDAL_CACHEMAX" in os.environ:
     GDAL_CACHEMAX = os.environ["GDAL_CACHEMAX"]
 else:
     GDAL_CACHEMAX = None
-if "COMPRESS_OVERVIEW" in os.environ:
-    COMPRESS_OVERVIEW = os.environ["COMPRESS_OVERVIEW"]
+if "GDAL_NUM_THREADS" in os.environ:
+    GDAL_NUM_THREADS = os.environ["GDAL_NUM_THREADS"]
+else:
+    GDAL_NUM_THREADS = None
+if "GDAL_DISABLE_READDIR_ON_OPEN" in os.environ:
+    GDAL_DISABLE_READDIR_ON_OPEN = os.environ["GDAL_DISABLE_READDIR_ON_OPEN"]
 else:
-    COMPRESS_OVERVIEW = None
+    GDAL_DISABLE_READDIR_ON_OPEN = None
+if "CPL_VSIL_CURL_ALLOWED_EXTENSIONS" in os.environ:
+    CPL_VSIL_CURL_ALLOWED_EXTENSIONS = os.environ["CPL_VSIL_CURL_ALLOWED_EXTENSIONS"]
+else:
+    CPL_VSIL_CURL_ALLOWED_EXTENSIONS = None
 
 records = {
     "2015": "3939038",
@@ -168,269 +192,851 @@ records = {
     "2019": "3939050",
 }
 
+# https://zenodo.org/record/3938963 (s. 28/29)
+DISCRETE_CLASSIFICATION_CODING = {
+    "0": "No inputdata available",
+    "111": "Closed forest, evergreen needle leaf",
+    "113": "Closed forest, deciduous needle leaf",
+    "112": "Closed forest, evergreen, broad leaf",
+    "114": "Closed forest, deciduous broad leaf",
+    "115": "Closed forest, mixed",
+    "116": "Closed forest, unknown",
+    "121": "Open forest, evergreen needle leaf",
+    "123": "Open forest, deciduous needle leaf",
+    "122": "Open forest, evergreen broad leaf",
+    "124": "Open forest, deciduous broad leaf",
+    "125": "Open forest, mixed",
+    "126": "Open forest, unknown",
+    "20": "Shrubs",
+    "30": "Herbaceous vegetation",
+    "90": "Herbaceous wetland",
+    "100": "Moss and lichen",
+    "60": "Bare / sparse vegetation",
+    "40": "Cultivated and managed vegetation/agriculture (cropland)",
+    "50": "Urban/ built up",
+    "70": "Snow and Ice",
+    "80": "Permanent water bodies",
+    "200": "Open sea",
+}
+
+# substring of the Zenodo file names and option of the output map per layer
+LAYER_KEYS = (
+    ("discrete-classification-map", "discrete_classification_output"),
+    ("bare-coverfraction", "bare_coverfraction_output"),
+    ("builtup-coverfraction", "builtup_coverfraction_output"),
+    ("crops-coverfraction", "crops_coverfraction_output"),
+    ("change-confidence", "change_confidence_output"),
+    ("datadensityindicator", "data_density_indicator_output"),
+    ("discrete-classification-proba", "discrete_classification_proba_output"),
+    ("forest-type", "forest_type_output"),
+    ("grass-coverfraction", "grass_coverfraction_output"),
+    ("mosslichen-coverfraction", "moss_lichen_coverfraction_output"),
+    ("permanentwater-coverfraction", "permanent_water_coverfraction_output"),
+    ("seasonalwater-coverfraction", "seasonal_water_coverfraction_output"),
+    ("shrub-coverfraction", "shrub_coverfraction_output"),
+    ("snow-coverfraction", "snow_coverfraction_output"),
+    ("tree-coverfraction", "tree_coverfraction_output"),
+)
+
+# default of the total number of connections used for downloading, which can
+# be set with the environment variable PROBAV_DOWNLOAD_CONCURRENCY
+DOWNLOAD_CONCURRENCY = 8
+# timeout in seconds of a stalled connection
+DOWNLOAD_TIMEOUT = 60
+# number of attempts per request and wait in seconds after the first attempt
+DOWNLOAD_RETRIES = 5
+DOWNLOAD_RETRY_WAIT = 3
+# files smaller than this are downloaded with a single request
+RANGE_DOWNLOAD_MIN_SIZE = 10 * 1024**2
+DOWNLOAD_CHUNK_SIZE = 1024**2
+# maximum age in seconds of the url and md5sum lists kept in the directory
+MANIFEST_MAX_AGE = 30 * 24 * 3600
+
 
 def cleanup():
     grass.message(_("Cleaning up.."))
     for folder in rm_folders:
         if os.path.isdir(folder):
             shutil.rmtree(folder)
-    if COMPRESS_OVERVIEW is not None:
-        os.environ["COMPRESS_OVERVIEW"] = COMPRESS_OVERVIEW
-    elif "GDAL_CACHEMAX" in os.environ:
-        del os.environ["COMPRESS_OVERVIEW"]
     if GDAL_CACHEMAX is not None:
         os.environ["GDAL_CACHEMAX"] = GDAL_CACHEMAX
-    elif "COMPRESS_OVERVIEW" in os.environ:
+    elif "GDAL_CACHEMAX" in os.environ:
         del os.environ["GDAL_CACHEMAX"]
+    if GDAL_NUM_THREADS is not None:
+        os.environ["GDAL_NUM_THREADS"] = GDAL_NUM_THREADS
+    elif "GDAL_NUM_THREADS" in os.environ:
+        del os.environ["GDAL_NUM_THREADS"]
+    if GDAL_DISABLE_READDIR_ON_OPEN is not None:
+        os.environ["GDAL_DISABLE_READDIR_ON_OPEN"] = GDAL_DISABLE_READDIR_ON_OPEN
+    elif "GDAL_DISABLE_READDIR_ON_OPEN" in os.environ:
+        del os.environ["GDAL_DISABLE_READDIR_ON_OPEN"]
+    if CPL_VSIL_CURL_ALLOWED_EXTENSIONS is not None:
+        os.environ["CPL_VSIL_CURL_ALLOWED_EXTENSIONS"] = (
+            CPL_VSIL_CURL_ALLOWED_EXTENSIONS
+        )
+    elif "CPL_VSIL_CURL_ALLOWED_EXTENSIONS" in os.environ:
+        del os.environ["CPL_VSIL_CURL_ALLOWED_EXTENSIONS"]
 
 
-def categories_for_discrete_classification():
-    # https://zenodo.org/record/3938963 (s. 28/29)
-    discrete_classification_coding = {
-        "0": "No inputdata available",
-        "111": "Closed forest, evergreen needle leaf",
-        "113": "Closed forest, deciduous needle leaf",
-        "112": "Closed forest, evergreen, broad leaf",
-        "114": "Closed forest, deciduous broad leaf",
-        "115": "Closed forest, mixed",
-        "116": "Closed forest, unknown",
-        "121": "Open forest, evergreen needle leaf",
-        "123": "Open forest, deciduous needle leaf",
-        "122": "Open forest, evergreen broad leaf",
-        "124": "Open forest, deciduous broad leaf",
-        "125": "Open forest, mixed",
-        "126": "Open forest, unknown",
-        "20": "Shrubs",
-        "30": "Herbaceous vegetation",
-        "90": "Herbaceous wetland",
-        "100": "Moss and lichen",
-        "60": "Bare / sparse vegetation",
-        "40": "Cultivated and managed vegetation/agriculture (cropland)",
-        "50": "Urban/ built up",
-        "70": "Snow and Ice",
-        "80": "Permanent water bodies",
-        "200": "Open sea",
-    }
-    # category
-    category_text = ""
-    for class_num, class_text in discrete_classification_coding.items():
-        category_text += "%s|%s\n" % (class_num, class_text)
-    cat_proc = grass.feed_command(
+def categories_for_discrete_classification(tmp_dir):
+    rules = "\n".join(
+        "%s|%s" % (class_num, class_text)
+        for class_num, class_text in DISCRETE_CLASSIFICATION_CODING.items()
+    )
+    rules_file = os.path.join(tmp_dir, "cats.txt")
+    with open(rules_file, "w") as file:
+        file.write(rules + "\n")
+    grass.run_command(
         "r.category",
         map=options["discrete_classification_output"],
-        rules="-",
+        rules=rules_file,
         separator="pipe",
     )
-    cat_proc.stdin.write(category_text.encode())
-    cat_proc.stdin.close()
-    cat_proc.wait()
+
+
+def get_free_memory():
+    # available memory in MB, from /proc/meminfo on Linux
+    try:
+        with open("/proc/meminfo") as file:
+            for line in file:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) / 1024.0
+    except OSError:
+        pass
+    return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE") / 1024.0**2
+
+
+def is_recent(path):
+    return (
+        os.path.isfile(path) and time.time() - os.path.getmtime(path) < MANIFEST_MAX_AGE
+    )
+
+
+def get_download_concurrency():
+    concurrency = os.environ.get("PROBAV_DOWNLOAD_CONCURRENCY", "")
+    if concurrency == "":
+        return DOWNLOAD_CONCURRENCY
+    try:
+        concurrency = int(concurrency)
+    except ValueError:
+        concurrency = 0
+    if concurrency < 1:
+        grass.fatal(
+            _("PROBAV_DOWNLOAD_CONCURRENCY must be a positive integer, not <%s>")
+            % os.environ["PROBAV_DOWNLOAD_CONCURRENCY"]
+        )
+    return concurrency
+
+
+def with_retries(function, *args):
+    # retries requests failing with connection errors, timeouts, rate limits
+    # (HTTP 429) or server errors with an increasing wait
+    for attempt in range(1, DOWNLOAD_RETRIES + 1):
+        try:
+            return function(*args)
+        except (OSError, http.client.HTTPException) as e:
+            if attempt == DOWNLOAD_RETRIES:
+                raise
+            wait = DOWNLOAD_RETRY_WAIT * attempt
+            if isinstance(e, urllib.error.HTTPError):
+                if e.code not in (408, 429) and e.code < 500:
+                    raise
+                retry_after = e.headers.get("Retry-After", "")
+                if retry_after.isdigit():
+                    wait = max(wait, int(retry_after))
+            time.sleep(wait)
+
+
+def get_download_info(url):
+    # a GET for the first byte instead of HEAD, which redirects turn into a
+    # full GET; a 206 answer with the total size shows range support
+    request = urllib.request.Request(url, headers={"Range": "bytes=0-0"})
+    with urllib.request.urlopen(request, timeout=DOWNLOAD_TIMEOUT) as response:
+        content_range = response.headers.get("Content-Range", "")
+        if response.status != 206 or "/" not in content_range:
+            return 0
+        size = content_range.rsplit("/", 1)[1]
+    return int(size) if size.isdigit() else 0
+
+
+def download_whole(url, path):
+    with urllib.request.urlopen(url, timeout=DOWNLOAD_TIMEOUT) as response:
+        with open(path, "wb") as file:
+            shutil.copyfileobj(response, file, DOWNLOAD_CHUNK_SIZE)
+
+
+def download_range(url, path, start, end):
+    request = urllib.request.Request(
+        url, headers={"Range": "bytes=%d-%d" % (start, end)}
+    )
+    with urllib.request.urlopen(request, timeout=DOWNLOAD_TIMEOUT) as response:
+        if response.status != 206:
+            raise Exception(_("Server ignored the range request"))
+        with open(path, "r+b") as file:
+            file.seek(start)
+            shutil.copyfileobj(response, file, DOWNLOAD_CHUNK_SIZE)
+
+
+def download_file(url, path, connections):
+    grass.message(_("Downloading %s ...") % os.path.basename(path))
+    size = 0
+    if connections > 1:
+        try:
+            size = with_retries(get_download_info, url)
+        except Exception:
+            # fall back to a single streamed download
+            size = 0
+    try:
+        if size > RANGE_DOWNLOAD_MIN_SIZE:
+            # preallocate the file and let each connection fill its own range
+            with open(path, "wb") as file:
+                if hasattr(os, "posix_fallocate"):
+                    os.posix_fallocate(file.fileno(), 0, size)
+                else:
+                    file.truncate(size)
+            step = -(-size // connections)
+            with ThreadPoolExecutor(max_workers=connections) as executor:
+                futures = [
+                    executor.submit(
+                        with_retries,
+                        download_range,
+                        url,
+                        path,
+                        start,
+                        min(start + step, size) - 1,
+                    )
+                    for start in range(0, size, step)
+                ]
+                for future in futures:
+                    future.result()
+        else:
+            with_retries(download_whole, url, path)
+    except Exception:
+        if os.path.isfile(path):
+            os.remove(path)
+        raise
+    return path
+
+
+def download_with_aria2c(urls, files_to_download, tmp_dir, parallel_files, connections):
+    # aria2c input file: one url per file followed by its options
+    input_file = os.path.join(tmp_dir, "aria2c_input.txt")
+    with open(input_file, "w") as file:
+        for filename, path in files_to_download.items():
+            file.write(
+                "%s\n  dir=%s\n  out=%s\n"
+                % (urls[filename], os.path.dirname(path), os.path.basename(path))
+            )
+    # aria2c allows at most 16 connections per server and download
+    connections = str(min(connections, 16))
+    grass.message(_("Downloading %d files with aria2c ...") % len(files_to_download))
+    proc = subprocess.run(
+        [
+            "aria2c",
+            "-i",
+            input_file,
+            "-j",
+            str(parallel_files),
+            "-x",
+            connections,
+            "-s",
+            connections,
+            "--max-tries=%d" % DOWNLOAD_RETRIES,
+            "--retry-wait=%d" % DOWNLOAD_RETRY_WAIT,
+            "--timeout=%d" % DOWNLOAD_TIMEOUT,
+            "--auto-file-renaming=false",
+            "--allow-overwrite=true",
+            "--console-log-level=warn",
+        ]
+    )
+    return proc.returncode
+
+
+def verify_md5(path, md5sum):
+    # hashlib reads the memory map directly without copying it into Python
+    # bytes and releases the GIL while hashing
+    with open(path, "rb") as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            md5 = hashlib.md5()
+        else:
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                md5 = hashlib.md5(mapped)
+    return md5.hexdigest() == md5sum
+
+
+def read_md5sums(md5file):
+    # one JSON object per line; later entries of a file override earlier ones
+    # and corrupt lines (e.g. from an interrupted run) are skipped
+    md5sums = dict()
+    with open(md5file) as file:
+        for line in file:
+            try:
+                entry = json.loads(line)
+                md5sums[entry["name"]] = entry["md5"]
+            except (ValueError, KeyError, TypeError):
+                continue
+    return md5sums
+
+
+def save_md5sum(md5file, filename, md5sum):
+    # appends one entry; a last line left incomplete by an interrupted run is
+    # terminated first, so that the new entry is not glued onto it
+    with open(md5file, "a+b") as file:
+        if file.seek(0, os.SEEK_END) > 0:
+            file.seek(-1, os.SEEK_END)
+            if file.read(1) != b"\n":
+                file.write(b"\n")
+        entry = json.dumps({"name": filename, "md5": md5sum}, separators=(",", ":"))
+        file.write(entry.encode() + b"\n")
+
+
+def record_md5_checks(md5_checks, md5sums, md5file, wait=False):
+    # saves the files whose md5sum check passed and returns the ones with a
+    # wrong md5sum; without wait only the already finished checks are handled
+    failed = []
+    for md5_check, filename in list(md5_checks.items()):
+        if not wait and not md5_check.done():
+            continue
+        del md5_checks[md5_check]
+        if not md5_check.result():
+            failed.append(filename)
+        elif md5file is not None:
+            save_md5sum(md5file, filename, md5sums[filename])
+    return failed
 
 
 def get_filenames(allfilenames):
     filename_list = dict()
-    # rastername_list = dict()
-    if options["discrete_classification_output"]:
-        for entry in allfilenames:
-            if "discrete-classification-map" in entry.lower():
-                filename_list[entry] = options["discrete_classification_output"]
-    if options["bare_coverfraction_output"]:
-        for entry in allfilenames:
-            if "bare-coverfraction" in entry.lower():
-                filename_list[entry] = options["bare_coverfraction_output"]
-    if options["builtup_coverfraction_output"]:
-        for entry in allfilenames:
-            if "builtup-coverfraction" in entry.lower():
-                filename_list[entry] = options["builtup_coverfraction_output"]
-    if options["crops_coverfraction_output"]:
-        for entry in allfilenames:
-            if "crops-coverfraction" in entry.lower():
-                filename_list[entry] = options["crops_coverfraction_output"]
-    if options["change_confidence_output"]:
-        for entry in allfilenames:
-            if "change-confidence" in entry.lower():
-                filename_list[entry] = options["change_confidence_output"]
-    if options["data_density_indicator_output"]:
-        for entry in allfilenames:
-            if "datadensityindicator" in entry.lower():
-                filename_list[entry] = options["data_density_indicator_output"]
-    if options["discrete_classification_proba_output"]:
-        for entry in allfilenames:
-            if "discrete-classification-proba" in entry.lower():
-                filename_list[entry] = options["discrete_classification_proba_output"]
-    if options["forest_type_output"]:
-        for entry in allfilenames:
-            if "forest-type" in entry.lower():
-                filename_list[entry] = options["forest_type_output"]
-    if options["grass_coverfraction_output"]:
-        for entry in allfilenames:
-            if "grass-coverfraction" in entry.lower():
-                filename_list[entry] = options["grass_coverfraction_output"]
-    if options["moss_lichen_coverfraction_output"]:
-        for entry in allfilenames:
-            if "mosslichen-coverfraction" in entry.lower():
-                filename_list[entry] = options["moss_lichen_coverfraction_output"]
-    if options["permanent_water_coverfraction_output"]:
-        for entry in allfilenames:
-            if "permanentwater-coverfraction" in entry.lower():
-                filename_list[entry] = options["permanent_water_coverfraction_output"]
-    if options["seasonal_water_coverfraction_output"]:
-        for entry in allfilenames:
-            if "seasonalwater-coverfraction" in entry.lower():
-                filename_list[entry] = options["seasonal_water_coverfraction_output"]
-    if options["shrub_coverfraction_output"]:
-        for entry in allfilenames:
-            if "shrub-coverfraction" in entry.lower():
-                filename_list[entry] = options["shrub_coverfraction_output"]
-    if options["snow_coverfraction_output"]:
-        for entry in allfilenames:
-            if "snow-coverfraction" in entry.lower():
-                filename_list[entry] = options["snow_coverfraction_output"]
-    if options["tree_coverfraction_output"]:
-        for entry in allfilenames:
-            if "tree-coverfraction" in entry.lower():
-                filename_list[entry] = options["tree_coverfraction_output"]
+    # only the requested layers are matched against the file names
+    wanted = [
+        (substring, options[option])
+        for substring, option in LAYER_KEYS
+        if options.get(option)
+    ]
+    for entry in allfilenames:
+        entry_lower = entry.lower()
+        for substring, out_name in wanted:
+            if substring in entry_lower:
+                filename_list[entry] = out_name
+                break
     return filename_list
 
 
+def get_dataset_bounds(dataset):
+    geotransform = dataset.GetGeoTransform()
+    return (
+        geotransform[0],
+        geotransform[3] + geotransform[5] * dataset.RasterYSize,
+        geotransform[0] + geotransform[1] * dataset.RasterXSize,
+        geotransform[3],
+    )
+
+
+def get_region_bounds(region):
+    ew_ints = [float(region["e"]), float(region["w"])]
+    ns_ints = [float(region["n"]), float(region["s"])]
+    return (min(ew_ints), min(ns_ints), max(ew_ints), max(ns_ints))
+
+
+def matches_region_grid(inpath, region):
+    # the file can only be linked if it has the resolution of the region and
+    # its cells are aligned with the region cells
+    dataset = Open(inpath)
+    if dataset is None:
+        grass.fatal(_("Unable to open scene %s." % inpath))
+    geotransform = dataset.GetGeoTransform()
+    dataset = None
+    ewres = float(region["ewres"])
+    nsres = float(region["nsres"])
+    if not (
+        math.isclose(geotransform[1], ewres, rel_tol=1e-6)
+        and math.isclose(abs(geotransform[5]), nsres, rel_tol=1e-6)
+    ):
+        return False
+    x_offset = (float(region["w"]) - geotransform[0]) / ewres
+    y_offset = (geotransform[3] - float(region["n"])) / nsres
+    return (
+        abs(x_offset - round(x_offset)) < 1e-3
+        and abs(y_offset - round(y_offset)) < 1e-3
+    )
+
+
+def get_warp_kwargs(bounds, proj, epsg):
+    kwargs = dict()
+    kwargs["dstSRS"] = "EPSG:{}".format(epsg)
+    kwargs["srcSRS"] = "EPSG:4326"
+    kwargs["outputBoundsSRS"] = kwargs["dstSRS"]
+    kwargs["outputBounds"] = bounds
+    if proj["unit"].lower() == "meter":
+        kwargs["xRes"] = 100
+        kwargs["yRes"] = 100
+        kwargs["targetAlignedPixels"] = True
+    return kwargs
+
+
+def get_aligned_grid(bounds, res):
+    # output grid (bounds, width, height) of targetAlignedPixels: the bounds
+    # are snapped outwards to multiples of the resolution
+    aligned = (
+        math.floor(bounds[0] / res) * res,
+        math.floor(bounds[1] / res) * res,
+        math.ceil(bounds[2] / res) * res,
+        math.ceil(bounds[3] / res) * res,
+    )
+    width = int(round((aligned[2] - aligned[0]) / res))
+    height = int(round((aligned[3] - aligned[1]) / res))
+    return aligned, width, height
+
+
+def get_warp_grids(inpaths, kwargs):
+    # without a fixed resolution (non-metric projected locations) GDAL derives
+    # the output grid (bounds, width, height) from the source; it is computed
+    # only once per source footprint, since all layers of a year share it
+    grids = dict()
+    footprints = dict()
+    for inpath in inpaths:
+        dataset = Open(inpath)
+        if dataset is None:
+            grass.fatal(_("Unable to open scene %s." % inpath))
+        footprint = (
+            dataset.GetProjection(),
+            dataset.GetGeoTransform(),
+            dataset.RasterXSize,
+            dataset.RasterYSize,
+        )
+        if footprint not in footprints:
+            # a warped VRT only holds the metadata of the output grid
+            vrt = Warp("", dataset, format="VRT", resampleAlg="near", **kwargs)
+            if vrt is None:
+                grass.fatal(_("Reprojection of Scene %s failed." % inpath))
+            footprints[footprint] = (
+                get_dataset_bounds(vrt),
+                vrt.RasterXSize,
+                vrt.RasterYSize,
+            )
+            vrt = None
+        dataset = None
+        grids[inpath] = footprints[footprint]
+    return grids
+
+
+def build_layer_inputs(filenames, download_dir, warp_dir, pid):
+    # one input per output map; several files of a layer are mosaicked
+    # into a VRT, so that they are reprojected and imported only once
+    layers = dict()
+    for file, out_name in filenames.items():
+        layers.setdefault(out_name, []).append(os.path.join(download_dir, file))
+    inputs = dict()
+    for out_name, paths in layers.items():
+        if len(paths) == 1:
+            inputs[out_name] = paths[0]
+            continue
+        vrt_path = os.path.join(warp_dir, "%s_%s_mosaic.vrt" % (out_name, pid))
+        if BuildVRT(vrt_path, paths, resolution="highest") is None:
+            grass.fatal(_("Building the mosaic of <%s> failed." % out_name))
+        inputs[out_name] = vrt_path
+    return inputs
+
+
+def clip_to_region(inpath, clip_path, bounds, epsg):
+    # clips the source to the area needed for the region (plus two source
+    # pixels for the resampling), so that only this part is warped; the
+    # clipped VRT only references the source and does not copy any data
+    dataset = Open(inpath)
+    if dataset is None:
+        grass.fatal(_("Unable to open scene %s." % inpath))
+    geotransform = dataset.GetGeoTransform()
+    in_bounds = get_dataset_bounds(dataset)
+    dataset = None
+    src_srs = osr.SpatialReference()
+    src_srs.ImportFromEPSG(4326)
+    dst_srs = osr.SpatialReference()
+    dst_srs.ImportFromEPSG(int(epsg))
+    for srs in (src_srs, dst_srs):
+        srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    transform = osr.CoordinateTransformation(dst_srs, src_srs)
+    # straight region borders are curved in EPSG:4326, so they are densified
+    steps = 20
+    points = []
+    for i in range(steps + 1):
+        x = bounds[0] + (bounds[2] - bounds[0]) * i / steps
+        y = bounds[1] + (bounds[3] - bounds[1]) * i / steps
+        points.extend([(x, bounds[1]), (x, bounds[3]), (bounds[0], y), (bounds[2], y)])
+    transformed = transform.TransformPoints(points)
+    lons = [point[0] for point in transformed]
+    lats = [point[1] for point in transformed]
+    # a pole inside the region is not on its border, the region then covers
+    # all longitudes up to this pole
+    pole_transform = osr.CoordinateTransformation(src_srs, dst_srs)
+    for pole_lat in (90.0, -90.0):
+        try:
+            pole_x, pole_y = pole_transform.TransformPoint(0.0, pole_lat)[:2]
+        except RuntimeError:
+            continue
+        if bounds[0] <= pole_x <= bounds[2] and bounds[1] <= pole_y <= bounds[3]:
+            lons.extend([-180.0, 180.0])
+            lats.append(pole_lat)
+    if not all(math.isfinite(coord) for coord in lons + lats):
+        return inpath
+    buffer_x = 2 * abs(geotransform[1])
+    buffer_y = 2 * abs(geotransform[5])
+    clip_bounds = (
+        max(min(lons) - buffer_x, in_bounds[0]),
+        max(min(lats) - buffer_y, in_bounds[1]),
+        min(max(lons) + buffer_x, in_bounds[2]),
+        min(max(lats) + buffer_y, in_bounds[3]),
+    )
+    if (
+        clip_bounds == in_bounds
+        or clip_bounds[0] >= clip_bounds[2]
+        or clip_bounds[1] >= clip_bounds[3]
+    ):
+        return inpath
+    if (
+        Translate(
+            clip_path,
+            inpath,
+            projWin=[clip_bounds[0], clip_bounds[3], clip_bounds[2], clip_bounds[1]],
+            format="VRT",
+        )
+        is None
+    ):
+        grass.fatal(_("Clipping of Scene %s failed." % inpath))
+    return clip_path
+
+
+def warp_and_import(
+    inpath,
+    out_name,
+    warp_dir,
+    pid,
+    epsg,
+    bounds,
+    warp_kwargs,
+    warp_memory,
+    import_memory,
+    grid,
+    link,
+):
+    if link:
+        # the downloaded file is kept in the directory and already has the
+        # CRS and grid of the region, so it is only linked
+        grass.run_command("r.external", input=inpath, output=out_name)
+        grass.message(_("Linked <%s>") % out_name)
+        return
+
+    # the clipped or warped data is only written as VRT and r.import reads
+    # it directly, so no intermediate GeoTIFF is written
+    outpath = os.path.join(warp_dir, "%s_%s_warped.vrt" % (out_name, pid))
+    if warp_kwargs is None:
+        # the location has the CRS of the data: clip instead of warping
+        dataset = Open(inpath)
+        if dataset is None:
+            grass.fatal(_("Unable to open scene %s." % inpath))
+        in_bounds = get_dataset_bounds(dataset)
+        dataset = None
+        if (
+            bounds[0] <= in_bounds[0]
+            and bounds[1] <= in_bounds[1]
+            and bounds[2] >= in_bounds[2]
+            and bounds[3] >= in_bounds[3]
+        ):
+            # the region covers the whole scene
+            outpath = inpath
+        else:
+            try:
+                dataset = Translate(
+                    outpath,
+                    inpath,
+                    projWin=[bounds[0], bounds[3], bounds[2], bounds[1]],
+                    format="VRT",
+                )
+                dataset = None
+            except Exception:
+                grass.fatal(_("Clipping of Scene %s failed." % inpath))
+    else:
+        kwargs = dict(warp_kwargs)
+        if grid is not None:
+            # reuse the output grid computed for scenes with this footprint
+            for key in ("xRes", "yRes", "targetAlignedPixels"):
+                kwargs.pop(key, None)
+            kwargs["outputBounds"], kwargs["width"], kwargs["height"] = grid
+        clip_path = os.path.join(warp_dir, "%s_%s_clip.vrt" % (out_name, pid))
+        # the output grid can reach past the region, the clip has to cover it
+        clip_bounds = bounds if grid is None else grid[0]
+        warp_input = clip_to_region(inpath, clip_path, clip_bounds, epsg)
+        try:
+            dataset = Warp(
+                outpath,
+                warp_input,
+                resampleAlg="near",
+                format="VRT",
+                warpMemoryLimit=warp_memory,
+                warpOptions=["NUM_THREADS=%s" % os.environ["GDAL_NUM_THREADS"]],
+                **kwargs,
+            )
+            dataset = None
+        except Exception:
+            grass.fatal(_("Reprojection of Scene %s failed." % inpath))
+    if not os.path.isfile(outpath):
+        grass.fatal(_("Reprojection of Scene %s failed." % inpath))
+
+    # import
+    grass.run_command(
+        "r.import",
+        input=outpath,
+        output=out_name,
+        resample="nearest",
+        memory=import_memory,
+    )
+    grass.message(_("Imported <%s>") % out_name)
+
+
 def main():
 
-    global rm_folders, download_dir, COMPRESS_OVERVIEW, GDAL_CACHEMAX
+    global rm_folders, download_dir, GDAL_CACHEMAX, GDAL_NUM_THREADS
 
     pid = str(os.getpid())
 
+    # do not scan the (possibly large) download directory for sidecar files
+    # every time GDAL opens a file
+    os.environ.setdefault("GDAL_DISABLE_READDIR_ON_OPEN", "EMPTY_DIR")
+    os.environ.setdefault("CPL_VSIL_CURL_ALLOWED_EXTENSIONS", ".tif")
+
     # year and record
     year = int(options["year"])
     record = records[options["year"]]
 
-    # request server
-    tmp_dir = grass.tempdir()
-    rm_folders.append(tmp_dir)
-    zenodo_get(["-r", record, "-w", "urls_%d_%s.txt" % (year, pid), "-o", tmp_dir])
+    # one temporary directory for everything that is removed at the end
+    work_dir = grass.tempdir()
+    rm_folders.append(work_dir)
+    zenodo_dir = os.path.join(work_dir, "zenodo")
+    warp_dir = os.path.join(work_dir, "warped")
+    for folder in (zenodo_dir, warp_dir):
+        os.makedirs(folder, exist_ok=True)
+
+    # download directory
+    if options["directory"]:
+        download_dir = os.path.join(options["directory"], str(year))
+        manifest_dir = download_dir
+    else:
+        download_dir = os.path.join(work_dir, "downloads")
+        manifest_dir = zenodo_dir
+    new_download_dir = not os.path.isdir(download_dir)
+    os.makedirs(download_dir, exist_ok=True)
+
+    # request server; the url and md5sum lists of a record do not change, so
+    # they are kept in the download directory and only requested again when
+    # they are older than MANIFEST_MAX_AGE
+    urls_file = os.path.join(manifest_dir, "urls_%d.txt" % year)
+    md5sums_file = os.path.join(manifest_dir, "md5sums.txt")
+    if is_recent(urls_file) and is_recent(md5sums_file):
+        grass.message(_("Using the url and md5sum lists in %s") % manifest_dir)
+    else:
+        zenodo_get(["-r", record, "-w", "urls_%d.txt" % year, "-o", manifest_dir])
 
     # get urls
-    with open(os.path.join(tmp_dir, "urls_%d_%s.txt" % (year, pid))) as file:
+    with open(urls_file) as file:
         urls = {
             os.path.basename(x): x
-            for x in file.read().split("\n")
-            if x != "" and x.endswith(".tif")
+            for x in (line.rstrip("\n") for line in file)
+            if x.endswith(".tif")
         }
 
     # get filenames
     filenames = get_filenames(urls)
 
     # md5sum
-    with open(os.path.join(tmp_dir, "md5sums.txt")) as file:
+    with open(md5sums_file) as file:
         md5sums = {
-            x.split(" ")[-1]: x.split(" ")[0]
-            for x in file.read().split("\n")
+            x.rpartition(" ")[2]: x.partition(" ")[0]
+            for x in (line.rstrip("\n") for line in file)
             if x != ""
         }
 
-    # download directory
+    # files to download
     files_to_download = dict()
     old_md5sums = dict()
     if options["directory"]:
-        dir = options["directory"]
-        download_dir = os.path.join(dir, str(year))
-        if not os.path.isdir(download_dir):
-            os.makedirs(download_dir)
+        if new_download_dir:
             files_to_download = {
                 filename: os.path.join(download_dir, filename) for filename in filenames
             }
         else:
-            md5file = os.path.join(download_dir, "md5sums.pkl")
+            md5file = os.path.join(download_dir, "md5sums.jsonl")
             if os.path.isfile(md5file):
-                with open(md5file, "rb") as pickle_in:
-                    old_md5sums = pickle.load(pickle_in)
-            else:
-                grass.warning(
-                    _(
-                        f"No old md5sums file found ({md5file}). "
-                        + "All tifs will be downloaded."
-                    )
-                )
+                old_md5sums = read_md5sums(md5file)
+            unrecorded = dict()
             for filename in filenames:
                 tif_path = os.path.join(download_dir, filename)
-                if os.path.isfile(tif_path):
-                    if (
-                        filename in old_md5sums
-                        and md5sums[filename] != old_md5sums[filename]
-                    ):
-                        files_to_download[filename] = tif_path
-                    elif filename not in old_md5sums:
-                        files_to_download[filename] = tif_path
-                else:
+                if not os.path.isfile(tif_path):
+                    files_to_download[filename] = tif_path
+                elif filename not in old_md5sums:
+                    unrecorded[filename] = tif_path
+                elif md5sums[filename] != old_md5sums[filename]:
                     files_to_download[filename] = tif_path
+            # existing files without a record (e.g. recorded in the
+            # md5sums.pkl of older versions) are verified against the md5sums
+            # of Zenodo instead of being downloaded again
+            if len(unrecorded) > 0:
+                grass.message(
+                    _("Verifying the md5sums of %d existing files ...")
+                    % len(unrecorded)
+                )
+                with ThreadPoolExecutor(max_workers=2) as executor:
+                    checks = {
+                        filename: executor.submit(
+                            verify_md5, tif_path, md5sums[filename]
+                        )
+                        for filename, tif_path in unrecorded.items()
+                    }
+                for filename, check in checks.items():
+                    if check.result():
+                        save_md5sum(md5file, filename, md5sums[filename])
+                    else:
+                        files_to_download[filename] = unrecorded[filename]
     else:
-        download_dir = grass.tempdir()
-        rm_folders.append(download_dir)
         files_to_download = {
             filename: os.path.join(download_dir, filename) for filename in filenames
         }
-    # download data
-    for file, path in files_to_download.items():
-        grass.message(_("Downloading %s ...") % file)
-        downloaded_file = wget.download(urls[file], out=path)
-        if os.path.isfile(downloaded_file):
-            old_md5sums[file] = md5sums[file]
-
-    # save new md5sums
-    if len(files_to_download) > 0 and options["directory"]:
-        md5file = os.path.join(download_dir, "md5sums.pkl")
-        with open(md5file, "wb") as f:
-            pickle.dump(old_md5sums, f, pickle.HIGHEST_PROTOCOL)
-
-    # gdalwarp for reprojection
-    for file, out_name in filenames.items():
-        inpath = os.path.join(download_dir, file)
-        free_memory = psutil.virtual_memory().free / 1024.0 ** 2  # bytes in MB
-        os.environ["GDAL_CACHEMAX"] = str(0.8 * free_memory)
-        os.environ["COMPRESS_OVERVIEW"] = "LZW"
-        kwargs = dict()
-        outpath = os.path.join(tmp_dir, "%s_%s.tif" % (file.replace(".tif", ""), pid))
-        region = grass.parse_command("g.region", flags="pagu")
-        proj = grass.parse_command("g.proj", flags="g")
-        if "epsg" in proj:
-            epsg = proj["epsg"]
-        else:
-            epsg = proj["srid"].split("EPSG:")[1]
-        kwargs["dstSRS"] = "EPSG:{}".format(epsg)
-        kwargs["srcSRS"] = "EPSG:4326"
-        kwargs["outputBoundsSRS"] = kwargs["dstSRS"]
-        ew_ints = [float(region["e"]), float(region["w"])]
-        ns_ints = [float(region["n"]), float(region["s"])]
-        kwargs["outputBounds"] = (
-            min(ew_ints),
-            min(ns_ints),
-            max(ew_ints),
-            max(ns_ints),
+    # download data and verify the md5sums while the next files are
+    # downloaded; each verified file is recorded right away, so it is not
+    # downloaded again if the module fails later on
+    if options["directory"]:
+        md5file = os.path.join(download_dir, "md5sums.jsonl")
+    else:
+        md5file = None
+    # the connections are split between the files downloaded at the same time
+    concurrency = get_download_concurrency()
+    parallel_files = max(1, min(len(files_to_download), concurrency))
+    connections = max(1, concurrency // parallel_files)
+    md5_executor = ThreadPoolExecutor(max_workers=2)
+    md5_checks = dict()
+    failed = []
+    download_error = None
+    if len(files_to_download) > 0 and shutil.which("aria2c"):
+        returncode = download_with_aria2c(
+            urls, files_to_download, work_dir, parallel_files, connections
         )
-        if proj["unit"].lower() == "meter":
-            kwargs["xRes"] = 100
-            kwargs["yRes"] = 100
-            kwargs["targetAlignedPixels"] = True
-        try:
-            Warp(
-                outpath,
-                inpath,
-                resampleAlg="near",
-                format="GTiff",
-                overviewLevel=5,
-                creationOptions=["TILED=YES", "COMPRESS=LZW"],
-                **kwargs,
+        if returncode != 0:
+            download_error = _("Downloading with aria2c failed (exit code %d)") % (
+                returncode
             )
-        except Exception:
-            grass.fatal(_("Reprojection of Scene %s failed." % inpath))
-        if not os.path.isfile(outpath):
-            grass.fatal(_("Reprojection of Scene %s failed." % inpath))
+        for file, path in files_to_download.items():
+            # aria2c keeps a control file next to incomplete downloads
+            if os.path.isfile(path) and not os.path.isfile(path + ".aria2"):
+                md5_checks[md5_executor.submit(verify_md5, path, md5sums[file])] = file
+    else:
+        with ThreadPoolExecutor(max_workers=parallel_files) as executor:
+            futures = {
+                executor.submit(download_file, urls[file], path, connections): file
+                for file, path in files_to_download.items()
+            }
+            for future in as_completed(futures):
+                file = futures[future]
+                if future.cancelled():
+                    continue
+                try:
+                    downloaded_file = future.result()
+                except Exception as e:
+                    # the running downloads are finished and verified, the
+                    # queued ones are cancelled
+                    if download_error is None:
+                        download_error = _("Downloading %s failed: %s") % (file, e)
+                        for pending in futures:
+                            pending.cancel()
+                    continue
+                if os.path.isfile(downloaded_file):
+                    md5_checks[
+                        md5_executor.submit(verify_md5, downloaded_file, md5sums[file])
+                    ] = file
+                failed.extend(record_md5_checks(md5_checks, md5sums, md5file))
+    failed.extend(record_md5_checks(md5_checks, md5sums, md5file, wait=True))
+    md5_executor.shutdown()
+    for file in failed:
+        os.remove(files_to_download[file])
+    if download_error is not None:
+        grass.fatal(download_error)
+    if len(failed) > 0:
+        grass.fatal(
+            _("The md5sum of the downloaded files %s is wrong.") % ", ".join(failed)
+        )
 
-        # import
-        grass.run_command("r.import", input=outpath, output=out_name)
-        grass.message(_("Imported <%s>") % (filenames[file]))
+    # gdalwarp for reprojection and import, one process per output map;
+    # everything derived from the region and projection is computed once
+    region = grass.parse_command("g.region", flags="pagu")
+    proj = grass.parse_command("g.proj", flags="g")
+    if "epsg" in proj:
+        epsg = proj["epsg"]
+    else:
+        epsg = proj["srid"].split("EPSG:")[1]
+    bounds = get_region_bounds(region)
+    # os.cpu_count() returns None if the number of CPUs is unknown
+    cpu_count = os.cpu_count() or 1
+    nprocs = max(1, min(len(set(filenames.values())), cpu_count))
+    # GDAL reads GDAL_CACHEMAX only once, at the first access to its block
+    # cache, so it is set before GDAL is used for the first time. The cache
+    # is allocated per process and given as percentage of the usable RAM.
+    os.environ["GDAL_CACHEMAX"] = "%d%%" % max(1, 80 // nprocs)
+    # share the CPUs and the warp memory between the processes
+    os.environ["GDAL_NUM_THREADS"] = str(max(1, cpu_count // nprocs))
+    free_memory = get_free_memory()  # MB
+    warp_memory = int(0.4 * free_memory * 1024**2 / nprocs)  # bytes
+    import_memory = int(0.5 * free_memory / nprocs)  # MB
+    inputs = build_layer_inputs(filenames, download_dir, warp_dir, pid)
+    if epsg == "4326" and proj["unit"].lower() != "meter":
+        warp_kwargs = None
+        grids = dict.fromkeys(inputs.values())
+    else:
+        warp_kwargs = get_warp_kwargs(bounds, proj, epsg)
+        if "xRes" in warp_kwargs:
+            # the output grid only depends on the region and the resolution
+            grid = get_aligned_grid(bounds, warp_kwargs["xRes"])
+            grids = dict.fromkeys(inputs.values(), grid)
+        else:
+            grids = get_warp_grids(inputs.values(), warp_kwargs)
+    links = dict.fromkeys(inputs.values(), False)
+    if flags["l"] and warp_kwargs is not None:
+        grass.warning(
+            _(
+                "The data can only be linked in EPSG:4326 locations. "
+                "The data will be imported."
+            )
+        )
+    elif flags["l"]:
+        for out_name, inpath in inputs.items():
+            # mosaics of several files are temporary and always imported
+            if os.path.dirname(inpath) != warp_dir:
+                links[inpath] = matches_region_grid(inpath, region)
+            if not links[inpath]:
+                grass.warning(
+                    _(
+                        "The grid of <%s> does not match the region, "
+                        "it will be imported."
+                    )
+                    % out_name
+                )
+    with ProcessPoolExecutor(max_workers=nprocs) as executor:
+        list(
+            executor.map(
+                warp_and_import,
+                inputs.values(),
+                inputs.keys(),
+                repeat(warp_dir),
+                repeat(pid),
+                repeat(epsg),
+                repeat(bounds),
+                repeat(warp_kwargs),
+                repeat(warp_memory),
+                repeat(import_memory),
+                [grids[inpath] for inpath in inputs.values()],
+                [links[inpath] for inpath in inputs.values()],
+            )
+        )
 
     # category for discrete classification:
     if options["discrete_classification_output"]:
-        categories_for_discrete_classification()
+        categories_for_discrete_classification(work_dir)
 
     return 0
 